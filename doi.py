@@ -1,65 +1,478 @@
 import re
+import html
+import json
 import time
+import sqlite3
+import os
+import contextlib
+import collections
 import requests
 import datetime
+import functools
+import threading
+import queue
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse, unquote, quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import bibtexparser
 from bibtexparser.bparser import BibTexParser
 from bibtexparser.customization import homogenize_latex_encoding
 from bibtexparser.bwriter import BibTexWriter
-from bibtexparser.bibdatabase import BibDatabase
+
+# orjson is optional: it parses large CrossRef responses faster, straight from bytes
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
 
 # ─── Constants ────────────────────────────────────────────────────────────────
-DOI2BIB_URL        = "https://doi2bib.org/bib/"
 CROSSREF_API_WORKS = "https://api.crossref.org/works"
-ARXIV_ABS_URL      = "https://arxiv.org/abs/"
+DOI_RESOLVER_URL   = "https://doi.org/"
+DOI_PREFIXES       = ("https://doi.org/", "http://doi.org/",
+                      "https://dx.doi.org/", "http://dx.doi.org/", "doi:")
+ARXIV_API_URL      = "https://export.arxiv.org/api/query"
+USER_AGENT         = "Pull-References-Full-Information-to-LaTeX (+https://github.com/farahaymen/Pull-References-Full-Information-to-LaTeX)"
 MAX_RETRIES        = 3
 BACKOFF_FACTOR     = 1  # seconds
+HTTP_TIMEOUT       = (3, 10)  # (connect, read) seconds
+MAX_WORKERS        = 8  # concurrent lookups; keeps us well under CrossRef's 50 req/s
+CROSSREF_BATCH     = 40  # DOIs per filter= query; longer URLs risk HTTP 414
+ARXIV_BATCH        = 100  # ids per arXiv API id_list query
+CACHE_PATH         = "bib_cache.sqlite"
+CACHE_TTL          = 30 * 86400  # seconds before a cached lookup is refetched
+
+# Client‑side rate limits per host: (requests, per seconds)
+RATE_LIMITS = {
+    'api.crossref.org': (50, 1),
+    'export.arxiv.org': (1, 3),  # arXiv API terms: one request every three seconds
+}
+
+# Maximum simultaneous in‑flight requests per host
+HOST_CONCURRENCY = {
+    'api.crossref.org': 8,
+    'export.arxiv.org': 1,
+}
+
+# CrossRef work type → BibTeX entry type (anything else becomes @misc)
+CROSSREF_BIBTEX_TYPES = {
+    'journal-article':     'article',
+    'proceedings-article': 'inproceedings',
+    'book-chapter':        'incollection',
+    'book':                'book',
+    'monograph':           'book',
+    'edited-book':         'book',
+    'dissertation':        'phdthesis',
+    'report':              'techreport',
+}
+
+# ─── Shared BibTeX writer, configured once ────────────────────────────────────
+# Entries are serialised one at a time; everything else is copied from the input
+WRITER = BibTexWriter()
+WRITER.order_entries_by = None  # keep the input order
+
+# ─── Pre‑compiled patterns ────────────────────────────────────────────────────
+_BLOCK_START_RE  = re.compile(r"@(?P<type>\w+)\s*\{")
+_NEXT_ENTRY_RE   = re.compile(r"^@\w+\s*\{", re.MULTILINE)
+_BLOCK_KEY_RE    = re.compile(r"\s*([^,\s{}]+)\s*,")
+_BRACE_RE        = re.compile(r"[{}]")
+_DOI_FIELD_RE    = re.compile(r'DOI\s*=\s*\{([^}]+)\}', re.IGNORECASE)
+_URL_FIELD_RE    = re.compile(r'url\s*=\s*\{([^}]+)\}', re.IGNORECASE)
+# A braced letter, unless it is the argument of a macro such as \textit{E}
+_SINGLE_BRACE_RE = re.compile(r"(\\[A-Za-z]+\{[A-Za-z]\})|\{([A-Za-z])\}")
+# Either a title starting with a double‑braced initial, or any braced letter as above
+_PROTECTED_RE    = re.compile(
+    r"(title\s*=\s*)\{\{([A-Za-z])\}(.*?)\}|(\\[A-Za-z]+\{[A-Za-z]\})|\{([A-Za-z])\}",
+    re.DOTALL
+)
+_BIBTEX_KEY_RE   = re.compile(r"^(\s*@\w+\s*\{)[^,]*")
+_MARKUP_TAG_RE   = re.compile(r"(</?[A-Za-z][\w:.-]*(?:\s[^<>]*)?/?>)")
+_TAG_NAME_RE     = re.compile(r"</?([\w:.-]+)")
+_CLEAN_TITLE_RE  = re.compile(r"[\\\{\}]")
+_NORMALIZE_RE    = re.compile(r"\W+")
+_ARXIV_VER_RE    = re.compile(r"v\d+$")
+
+# Atom namespaces used by the arXiv API
+ARXIV_NS = {
+    'atom':  'http://www.w3.org/2005/Atom',
+    'arxiv': 'http://arxiv.org/schemas/atom',
+}
+
+# ─── Canonical DOI form, used for every cache key and duplicate check ─────────
+def _canon_doi(doi: str) -> str:
+    doi = doi.strip().lower()
+    for prefix in DOI_PREFIXES:
+        if doi.startswith(prefix):
+            doi = doi[len(prefix):].strip()
+            break
+    return unquote(doi)
+
+# ─── Registry of DOIs already injected, to prevent duplicates ─────────────────
+class DoiRegistry:
+    """Thread‑safe set of DOIs with an atomic check‑and‑add."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dois = set()
+
+    def claim(self, doi: str) -> bool:
+        """Mark `doi` as used; False if it already was."""
+        with self._lock:
+            before = len(self._dois)
+            self._dois.add(doi)
+            return len(self._dois) != before
+
+    def claim_all(self, dois):
+        with self._lock:
+            self._dois.update(dois)
 
-# Track which DOIs we've already injected, to prevent duplicates
-used_dois = set()
+used_dois = DoiRegistry()
+
+# ─── Shared HTTP session: keep‑alive, connection pooling, retry/backoff ───────
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = USER_AGENT
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=(500, 502, 503, 504),  # 429 is handled by http_get
+        respect_retry_after_header=False,  # else urllib3 would retry 429s itself
+        raise_on_status=False,  # let raise_for_status() report the final error
+    ),
+))
+
+# ─── Per‑host token bucket ────────────────────────────────────────────────────
+class RateLimiter:
+    """Thread‑safe token bucket allowing `rate` requests per `per` seconds."""
+
+    def __init__(self, rate: float, per: float = 1.0):
+        self._lock         = threading.Lock()
+        self.rate          = rate
+        self.per           = per
+        self._tokens       = rate
+        self._stamp        = time.monotonic()
+        self._paused_until = 0.0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    elapsed      = now - self._stamp
+                    self._tokens = min(self.rate, self._tokens + elapsed * self.rate / self.per)
+                    self._stamp  = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) * self.per / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hold back every caller for `seconds`, e.g. after a 429."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def tune(self, headers):
+        """Adopt the server's X-Rate-Limit-Limit / X-Rate-Limit-Interval, if sent."""
+        try:
+            rate = float(headers['X-Rate-Limit-Limit'])
+            per  = float(headers['X-Rate-Limit-Interval'].rstrip('s'))
+        except (KeyError, ValueError):
+            return
+        if rate > 0 and per > 0:
+            with self._lock:
+                self.rate, self.per = rate, per
+
+LIMITERS   = {host: RateLimiter(*limit) for host, limit in RATE_LIMITS.items()}
+HOST_SLOTS = {host: threading.BoundedSemaphore(n) for host, n in HOST_CONCURRENCY.items()}
+
+def retry_after(resp):
+    """Seconds to wait according to a Retry-After header, or None."""
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
 
-# ─── HTTP helper with rate‑limit backoff ────────────────────────────────────────
+# ─── HTTP helper with rate limiting and Retry-After aware 429 handling ────────
 def http_get(url, **kwargs):
+    host    = urlparse(url).hostname
+    limiter = LIMITERS.get(host)
+    slot    = HOST_SLOTS.get(host, contextlib.nullcontext())
     for attempt in range(1, MAX_RETRIES + 1):
-        resp = requests.get(url, **kwargs)
-        if resp.status_code == 429:
-            wait = BACKOFF_FACTOR * (2 ** (attempt - 1))
-            print(f"WARNING: 429 from {url}, retrying in {wait}s…")
-            time.sleep(wait)
+        with slot:
+            if limiter:
+                limiter.acquire()
+            resp = SESSION.get(url, timeout=HTTP_TIMEOUT, **kwargs)
+        if limiter:
+            limiter.tune(resp.headers)
+        if resp.status_code == 429 and attempt < MAX_RETRIES:
+            wait = retry_after(resp)
+            if wait is None:
+                wait = BACKOFF_FACTOR * (2 ** (attempt - 1))
+            print(f"WARNING: 429 from {url}, retrying in {wait:g}s…")
+            if limiter:
+                limiter.pause(wait)
+            else:
+                time.sleep(wait)
             continue
-        resp.raise_for_status()
-        return resp
+        break
     resp.raise_for_status()
+    return resp
+
+# ─── Persistent lookup cache (SQLite) ─────────────────────────────────────────
+_cache_conn = None
+_cache_lock = threading.Lock()
+
+def _cache_db():
+    global _cache_conn
+    if _cache_conn is None:
+        _cache_conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _cache_conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache"
+            " (key TEXT PRIMARY KEY, value TEXT, ts INTEGER)"
+        )
+    return _cache_conn
+
+def cache_get(key: str):
+    with _cache_lock:
+        row = _cache_db().execute(
+            "SELECT value, ts FROM cache WHERE key=?", (key,)
+        ).fetchone()
+    if row and time.time() - row[1] < CACHE_TTL:
+        return row[0]
+    return None
+
+def cache_put(key: str, value: str):
+    with _cache_lock:
+        conn = _cache_db()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, ts) VALUES (?, ?, ?)",
+            (key, value, int(time.time()))
+        )
+        conn.commit()
+
+def cached(namespace: str, keyfunc=None):
+    """Memoize a lookup in‑process and in the on‑disk cache; errors aren't cached.
+
+    `keyfunc(*args)` maps the arguments to the cache key, so inputs that
+    differ only cosmetically can share one entry.
+    """
+    def decorator(fn):
+        memo = {}
+
+        @functools.wraps(fn)
+        def wrapper(*args):
+            key = namespace + ":" + (keyfunc(*args) if keyfunc else "\x1f".join(args))
+            if key in memo:
+                return memo[key]
+            value = cache_get(key)
+            if value is None:
+                value = fn(*args)
+                cache_put(key, value)
+            memo[key] = value
+            return value
+        return wrapper
+    return decorator
 
 # ─── BibTeX text cleanup ──────────────────────────────────────────────────────
+def _unbrace(m) -> str:
+    return m.group(1) or m.group(2)
+
+def _unprotect(m) -> str:
+    if m.group(4) or m.group(5):
+        return m.group(4) or m.group(5)
+    # Merge the double‑braced initial into the title's braces; the merged
+    # text can itself end in a braced letter (e.g. "{{A}bc {D}ef}")
+    return _SINGLE_BRACE_RE.sub(_unbrace, f"{m.group(1)}{{{m.group(2)+m.group(3)}}}")
+
 def clean_protected_case(bibtex_str: str) -> str:
-    # Merge double‑braced initials into single braces, then strip
-    bibtex_str = re.sub(
-        r"(title\s*=\s*)\{\{([A-Za-z])\}(.*?)\}",
-        lambda m: f"{m.group(1)}{{{m.group(2)+m.group(3)}}}",
-        bibtex_str,
-        flags=re.DOTALL
-    )
-    bibtex_str = re.sub(r"\{([A-Za-z])\}", r"\1", bibtex_str)
-    return bibtex_str
+    # Merge double‑braced initials into single braces and strip {X}, in one pass
+    if '{' not in bibtex_str:
+        return bibtex_str
+    return _PROTECTED_RE.sub(_unprotect, bibtex_str)
 
-# ─── Fetch BibTeX by DOI via doi2bib.org (with CrossRef fallback) ─────────────
-def fetch_bibtex_from_doi(doi: str) -> str:
-    url = DOI2BIB_URL + doi
+# ─── Fetch one CrossRef work record (JSON text) by canonical DOI ──────────────
+@cached('crossref')
+def fetch_crossref_work(doi: str) -> str:
+    resp = http_get(f"{CROSSREF_API_WORKS}/{doi}",
+                    headers={'Accept': 'application/json'})
+    return json_dumps(json_loads(resp.content)['message'])
+
+# ─── Parsed CrossRef work record, decoded once per DOI per run ────────────────
+@functools.lru_cache(maxsize=None)
+def crossref_work(doi: str) -> dict:
+    return json_loads(fetch_crossref_work(doi))
+
+# ─── Fetch BibTeX from doi.org content negotiation (DataCite, mEDRA, …) ───────
+@cached('doiorg')
+def fetch_doiorg_bibtex(doi: str) -> str:
+    resp = http_get(DOI_RESOLVER_URL + quote(doi, safe="/:;()"),
+                    headers={'Accept': 'application/x-bibtex'})
+    resp.encoding = 'utf-8'
+    text = resp.text.strip()
+    if not text.startswith('@'):
+        raise ValueError(f"doi.org returned no BibTeX for {doi}")
+    return text + "\n"
+
+# ─── Fetch BibTeX by DOI: CrossRef record formatted locally, else doi.org ─────
+def fetch_bibtex_from_doi(doi: str, key: str = None) -> str:
+    doi = _canon_doi(doi)
     try:
-        text = http_get(url).text
+        work = crossref_work(doi)
     except requests.HTTPError as e:
-        if e.response.status_code == 404:
-            print(f" doi2bib.org miss for {doi}, using CrossRef fallback")
-            url2 = f"{CROSSREF_API_WORKS}/{doi}/transform/application/x-bibtex"
-            text = http_get(url2, headers={'Accept': 'application/x-bibtex'}).text
-        else:
+        if e.response is None or e.response.status_code != 404:
             raise
-    return clean_protected_case(text)
+        # Not a CrossRef DOI; its own registration agency may still know it
+        print(f" CrossRef miss for {doi}, using doi.org fallback")
+        text = fetch_doiorg_bibtex(doi)
+        return _BIBTEX_KEY_RE.sub(lambda m: m.group(1) + key, text, 1) if key else text
+    return bibtex_from_crossref_json(work, key)
+
+# ─── CrossRef text (HTML entities, JATS/HTML markup) → LaTeX ──────────────────
+LATEX_SPECIALS = {
+    '\\': r'\textbackslash{}', '{': r'\{', '}': r'\}', '&': r'\&', '%': r'\%',
+    '$':  r'\$', '#': r'\#', '_': r'\_', '~': r'\textasciitilde{}', '^': r'\textasciicircum{}',
+}
+MARKUP_COMMANDS = {
+    'i': 'textit', 'em': 'textit', 'italic': 'textit',
+    'b': 'textbf', 'strong': 'textbf', 'bold': 'textbf',
+    'sub': 'textsubscript', 'sup': 'textsuperscript',
+    'sc': 'textsc', 'scp': 'textsc',
+}
+# Other JATS/HTML elements CrossRef puts in titles; dropped, keeping their text
+MARKUP_DROPPED = {
+    'p', 'br', 'span', 'title', 'label', 'sec', 'break', 'underline',
+    'monospace', 'ext-link', 'inline-formula', 'math', 'mi', 'mn', 'mo',
+    'mrow', 'msub', 'msup', 'mtext',
+}
+
+def latex_from_markup(text: str) -> str:
+    """Escape LaTeX specials; known tags become commands or are dropped.
+
+    Anything else that looks like a tag (``n<k and k>2``) is kept as text.
+    """
+    out, open_tags = [], []
+    for part in _MARKUP_TAG_RE.split(text):
+        tag   = _MARKUP_TAG_RE.fullmatch(part) and _TAG_NAME_RE.match(part)
+        qname = tag.group(1).lower() if tag else ""
+        name  = qname.split(':')[-1]
+        if not (name in MARKUP_COMMANDS or name in MARKUP_DROPPED or ':' in qname):
+            out.append("".join(LATEX_SPECIALS.get(c, c) for c in html.unescape(part)))
+            continue
+        closing = part.startswith('</')
+        command = MARKUP_COMMANDS.get(name)
+        if not command or part.endswith('/>'):
+            continue
+        if not closing:
+            out.append(f"\\{command}{{")
+            open_tags.append(name)
+        elif name in open_tags:
+            # close anything left open inside it, keeping braces balanced
+            while open_tags:
+                out.append("}")
+                if open_tags.pop() == name:
+                    break
+    out.append("}" * len(open_tags))
+    return "".join(out)
+
+# ─── Build a BibTeX entry locally from a CrossRef work record ─────────────────
+def bibtex_from_crossref_json(item: dict, key: str = None) -> str:
+    authors = []
+    for a in item.get('author', []):
+        family, given = a.get('family', ''), a.get('given', '')
+        if family and given:
+            authors.append(f"{family}, {given}")
+        else:
+            authors.append(family or given or a.get('name', ''))
+    year = (item.get('issued', {}).get('date-parts') or [[None]])[0][0]
+    if key is None:
+        first = (item.get('author') or [{}])[0]
+        key   = f"{first.get('family', 'Anon')}_{year or 'nd'}".replace(' ', '')
+
+    etype     = CROSSREF_BIBTEX_TYPES.get(item.get('type'), 'misc')
+    container = (item.get('container-title') or [""])[0]
+    fields = [
+        ('author',    " and ".join(authors)),
+        ('title',     (item.get('title') or [''])[0]),
+        ('booktitle' if etype in ('inproceedings', 'incollection') else 'journal', container),
+        ('year',      year),
+        ('volume',    item.get('volume')),
+        ('number',    item.get('issue')),
+        ('pages',     item.get('page')),
+        ('publisher', item.get('publisher')),
+        ('doi',       item.get('DOI')),
+    ]
+    lines = []
+    for name, value in fields:
+        if value:
+            value = str(value) if name == 'doi' else latex_from_markup(str(value))
+            if name == 'title':
+                value = f"{{{value}}}"  # protect the title's capitalisation
+            lines.append(f"  {name} = {{{value}}}")
+    body = ",\n".join(lines)
+    return f"@{etype}{{{key},\n{body}\n}}\n"
+
+# ─── Look up many DOIs at once via CrossRef's filter=doi: query ───────────────
+def fetch_crossref_works(dois) -> dict:
+    """Return {canonical DOI: CrossRef work}; unknown DOIs are simply absent."""
+    works   = {}
+    pending = []
+    for d in dict.fromkeys(_canon_doi(d) for d in dois):
+        hit = cache_get("crossref:" + d)
+        if hit is not None:
+            works[d] = json_loads(hit)
+        else:
+            pending.append(d)
+    for i in range(0, len(pending), CROSSREF_BATCH):
+        chunk  = pending[i:i + CROSSREF_BATCH]
+        params = {
+            'filter': ",".join(f"doi:{d}" for d in chunk),
+            'rows':   len(chunk)
+        }
+        # A non‑JSON body or a malformed item only loses this batch; its DOIs
+        # are then looked up one by one
+        try:
+            resp  = http_get(CROSSREF_API_WORKS, params=params,
+                             headers={'Accept': 'application/json'})
+            items = json_loads(resp.content).get('message', {}).get('items', [])
+            found = {_canon_doi(item['DOI']): item for item in items}
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f" • CrossRef batch lookup failed for {len(chunk)} DOIs: {e}")
+            continue
+        for doi, item in found.items():
+            works[doi] = item
+            cache_put("crossref:" + doi, json_dumps(item))
+    return works
+
+# ─── Title normalization for exact‑match comparison ───────────────────────────
+@functools.lru_cache(maxsize=4096)
+def _norm(s: str) -> str:
+    return _NORMALIZE_RE.sub("", s.lower())
 
 # ─── Search CrossRef by title+author, require exact title match ───────────────
+@cached('search', keyfunc=lambda title, author: _norm(title) + "\x1f" + (author or ""))
 def search_doi_by_metadata(title: str, author: str) -> str:
-    title_clean = re.sub(r"[\\\{\}]", "", title).strip()
+    title_clean = _CLEAN_TITLE_RE.sub("", title).strip()
     params = {
         'query.title':  title_clean,
         'query.author': author or "",
@@ -67,141 +480,354 @@ def search_doi_by_metadata(title: str, author: str) -> str:
     }
     resp = http_get(CROSSREF_API_WORKS, params=params,
                     headers={'Accept': 'application/json'})
-    items = resp.json().get('message', {}).get('items', [])
+    items = json_loads(resp.content).get('message', {}).get('items', [])
     if not items:
         raise ValueError(f"No DOI candidates for “{title_clean}”")
 
-    def normalize(s: str) -> str:
-        return re.sub(r"\W+", "", s).lower()
-
-    target_norm = normalize(title_clean)
+    target_norm = _norm(title_clean)
     for item in items:
         cand = item.get('title', [""])[0]
-        if normalize(cand) == target_norm:
+        # _norm() never lengthens a string, so a shorter raw title can't match
+        if len(cand) < len(target_norm):
+            continue
+        if _norm(cand) == target_norm:
             return item['DOI']
 
     raise ValueError(f"No exact‑match DOI for “{title_clean}”")
 
-# ─── If an entry links to arXiv, grab the DOI from the abstract page ────────────
+# ─── Look up journal DOIs for many arXiv ids via the arXiv API ────────────────
+def fetch_arxiv_dois(arxiv_ids) -> dict:
+    """Return {arXiv id: DOI}, with "" for papers arXiv lists no DOI for.
+
+    Both outcomes are cached; ids the API could not be asked about are absent.
+    """
+    dois    = {}
+    pending = []
+    for aid in dict.fromkeys(arxiv_ids):
+        hit = cache_get("arxiv:" + aid)
+        if hit is not None:
+            dois[aid] = hit
+        else:
+            pending.append(aid)
+    for i in range(0, len(pending), ARXIV_BATCH):
+        chunk  = pending[i:i + ARXIV_BATCH]
+        params = {'id_list': ",".join(chunk), 'max_results': len(chunk)}
+        try:
+            resp = http_get(ARXIV_API_URL, params=params)
+            feed = ET.fromstring(resp.content)
+        except (requests.RequestException, ET.ParseError) as e:
+            print(f" • arXiv lookup failed for {len(chunk)} ids: {e}")
+            continue
+        # The feed reports versioned ids (…/abs/2101.00001v2); match on the base id
+        found = {}
+        for entry in feed.findall('atom:entry', ARXIV_NS):
+            aid = entry.findtext('atom:id', '', ARXIV_NS).rsplit('/abs/', 1)[-1]
+            doi = entry.findtext('arxiv:doi', '', ARXIV_NS)
+            found[_ARXIV_VER_RE.sub("", aid)] = _canon_doi(doi) if doi else ""
+        for aid in chunk:
+            doi = found.get(aid, found.get(_ARXIV_VER_RE.sub("", aid)))
+            if doi is not None:
+                dois[aid] = doi
+                cache_put("arxiv:" + aid, doi)
+    return dois
+
+# ─── If an entry links to arXiv, get its journal DOI ──────────────────────────
 def extract_arxiv_doi(arxiv_id: str) -> str:
-    resp = http_get(ARXIV_ABS_URL + arxiv_id)
-    match = re.search(r'href="(https?://doi.org/[^"]+)"', resp.text)
-    if not match:
-        raise ValueError(f"No journal DOI on arXiv page {arxiv_id}")
-    return match.group(1).split('/')[-1]
+    doi = fetch_arxiv_dois([arxiv_id]).get(arxiv_id)
+    if not doi:
+        raise ValueError(f"No journal DOI on arXiv for {arxiv_id}")
+    return doi
+
+# ─── arXiv id from an arxiv.org/abs/ URL (old‑style ids contain a slash) ──────
+def arxiv_id(url: str) -> str:
+    return url.strip().split('arxiv.org/abs/', 1)[-1].rstrip('/')
+
+# ─── BibTeX for a DOI, preferring an already prefetched CrossRef record ───────
+def bibtex_for_doi(doi: str, key: str = None, prefetched: dict = None) -> str:
+    item = (prefetched or {}).get(doi)
+    if item:
+        return bibtex_from_crossref_json(item, key)
+    return fetch_bibtex_from_doi(doi, key)
+
+# ─── DOI of an entry: its doi field, or a doi.org link in its url field ───────
+def entry_doi(ent):
+    if ent.get('doi'):
+        return _canon_doi(ent['doi'])
+    urlf = ent.get('url', '').strip()
+    if 'doi.org/' in urlf:
+        return _canon_doi(urlf.split('doi.org/')[-1])
+    return None
+
+# ─── Decide which enrichment branch an entry takes (no network) ───────────────
+def classify_entry(ent) -> str:
+    urlf = ent.get('url', '').strip()
+    if entry_doi(ent):
+        return 'doi'
+    if urlf and "doi.org" not in urlf and "arxiv.org/abs" not in urlf:
+        return 'url'
+    if 'arxiv.org/abs' in urlf:
+        return 'arxiv'
+    return 'metadata'
+
+# ─── Enrich a single entry according to its branch ────────────────────────────
+def enrich_entry(ent, branch, prefetched=None, listed=()):
+    """Return (discovered DOI, replacement BibTeX) for `ent`.
+
+    The BibTeX is None to keep the entry as it is. A discovered DOI (from
+    arXiv or a metadata search) is not claimed here: the writer claims it in
+    file order, so which duplicate wins doesn't depend on thread timing.
+    DOIs in `listed` belong to entries that list them and are never used.
+    """
+    key  = ent['ID']
+    doi  = None
+    repl = None
+
+    # ─── 1) URL‑only → format as @misc ──────────────────────────────────────
+    if branch == 'url':
+        urlf   = ent['url'].strip()
+        author = ent.get('author', '')
+        title  = ent.get('title', '').replace('\n',' ').strip()
+        year   = ent.get('year', datetime.date.today().year)
+        today  = datetime.date.today().isoformat()
+        return None, (
+            f"@misc{{{key},\n"
+            f"  author       = {{{author}}},\n"
+            f"  title        = {{{title}}},\n"
+            f"  howpublished = {{\\url{{{urlf}}}}},\n"
+            f"  year         = {{{year}}},\n"
+            f"  note         = {{Accessed: {today}}},\n"
+            f"}}\n"
+        )
+
+    # ─── 2) ArXiv URL → resolve to DOI → fetch BibTeX ────────────────────
+    if branch == 'arxiv':
+        aid = arxiv_id(ent['url'])
+        try:
+            found = extract_arxiv_doi(aid)
+            if found not in listed:
+                doi, repl = found, bibtex_for_doi(found, key)
+        except Exception:
+            pass
+        if repl is None:
+            branch = 'metadata'
+
+    # ─── 3) No DOI → metadata search with exact title match ───────────────
+    if branch == 'metadata':
+        try:
+            found = search_doi_by_metadata(ent.get('title',''),
+                                           ent.get('author',''))
+            found = _canon_doi(found)
+            if found in listed:
+                print(f" SKIPPING duplicate DOI {found} for {key}")
+            else:
+                doi, repl = found, bibtex_for_doi(found, key)
+        except Exception as e:
+            print(f" • metadata search failed for {key}: {e}")
+
+    # ─── 4) Direct DOI present → fetch BibTeX (claimed up front) ───────────
+    if branch == 'doi':
+        try:
+            repl = bibtex_for_doi(entry_doi(ent), key, prefetched)
+        except Exception as e:
+            print(f" • DOI lookup failed for {key}: {e}")
+
+    # ─── 5) Nothing fetched → keep the original entry ─────────────────────
+    return doi, repl
+
+# ─── Pipeline stage 2: network lookups, several workers ───────────────────────
+def fetch_worker(fetch_q, done_q, doi_index, prefetched):
+    while True:
+        task = fetch_q.get()
+        if task is None:
+            return
+        i, ent, branch = task
+        try:
+            if branch == 'doi' and doi_index[entry_doi(ent)] is not ent:
+                print(f" SKIPPING duplicate DOI {entry_doi(ent)} for {ent['ID']}")
+                result = None, None
+            else:
+                result = enrich_entry(ent, branch, prefetched, doi_index)
+        except Exception as e:
+            result = e
+        done_q.put((i, result))
+
+# ─── Split the raw .bib into entry blocks and the text between them ───────────
+def split_bib_blocks(raw_text: str):
+    """Yield (type, key, start, end) for every entry block, in file order.
+
+    Text between entries (and @comment/@string/@preamble blocks) comes out as
+    (None, None, start, end), so it can be copied through where it stands. An
+    entry whose braces never close ends where the next entry starts.
+    """
+    pos = 0
+    while True:
+        m = _BLOCK_START_RE.search(raw_text, pos)
+        if m is None:
+            break
+        nxt   = _NEXT_ENTRY_RE.search(raw_text, m.end())
+        end   = nxt.start() if nxt else len(raw_text)
+        depth = 0
+        for b in _BRACE_RE.finditer(raw_text, m.end() - 1, end):
+            depth += 1 if b.group() == '{' else -1
+            if depth == 0:
+                end = b.end()
+                break
+        etype = m.group('type').lower()
+        if etype in ('comment', 'string', 'preamble'):
+            yield None, None, pos, end
+        else:
+            if m.start() > pos:
+                yield None, None, pos, m.start()
+            k = _BLOCK_KEY_RE.match(raw_text, m.end(), end)
+            yield etype, k.group(1) if k else None, m.start(), end
+        pos = end
+    if pos < len(raw_text):
+        yield None, None, pos, len(raw_text)
+
+# ─── DOI of an entry block the parser could not read ──────────────────────────
+def raw_block_doi(block: str):
+    m1 = _DOI_FIELD_RE.search(block)
+    if m1:
+        return _canon_doi(m1.group(1))
+    m2 = _URL_FIELD_RE.search(block)
+    if m2 and 'doi.org/' in m2.group(1):
+        return _canon_doi(m2.group(1).split('doi.org/')[-1])
+    return None
+
+# ─── Write a file under a temporary name, moved into place only on success ────
+@contextlib.contextmanager
+def atomic_output(path: str):
+    """Yield a text file that replaces `path` once the block exits cleanly.
+
+    On an error the temporary file is removed and `path` is left untouched.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            yield f
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+# ─── Stop the fetch workers early: drop queued tasks, then end each worker ────
+def stop_workers(fetch_q):
+    while True:
+        try:
+            fetch_q.get_nowait()
+        except queue.Empty:
+            break
+    for _ in range(MAX_WORKERS):
+        fetch_q.put(None)
 
 # ─── Main enrichment pipeline ─────────────────────────────────────────────────
 def process_bib_file(input_path: str, output_path: str):
-    raw_text = open(input_path, encoding='utf-8', errors='ignore').read()
+    with open(input_path, encoding='utf-8', errors='ignore') as f:
+        raw_text = f.read()
 
-    entry_pattern = re.compile(
-        r'@(?P<type>\w+)\{(?P<key>[^,]+),(?P<body>.*?)(?=(^@\w+\{)|\Z)',
-        re.DOTALL | re.MULTILINE
-    )
-
-    # Load structured entries for easy field access
-    parser     = BibTexParser()
+    # Single parse; non‑standard entry types are kept so they can be enriched too
+    parser = BibTexParser(ignore_nonstandard_types=False)
     parser.customization = homogenize_latex_encoding
-    structured = {
-        e['ID']: e
-        for e in bibtexparser.load(
-            open(input_path, encoding='utf-8', errors='ignore'),
-            parser
-        ).entries
-    }
-    writer = BibTexWriter()
-    replacements = []
-
-    for m in entry_pattern.finditer(raw_text):
-        key        = m.group('key')
-        start, end = m.span()
-        ent        = structured.get(key)
-        repl       = None
-
-        if ent:
-            doi  = ent.get('doi')
-            urlf = ent.get('url', '').strip()
-
-            # ─── 1) URL‑only → format as @misc ──────────────────────────────────
-            if not doi and urlf and "doi.org" not in urlf and "arxiv.org/abs" not in urlf:
-                author = ent.get('author', '')
-                title  = ent.get('title', '').replace('\n',' ').strip()
-                year   = ent.get('year', datetime.date.today().year)
-                today  = datetime.date.today().isoformat()
-                misc = (
-                    f"@misc{{{key},\n"
-                    f"  author       = {{{author}}},\n"
-                    f"  title        = {{{title}}},\n"
-                    f"  howpublished = {{\\url{{{urlf}}}}},\n"
-                    f"  year         = {{{year}}},\n"
-                    f"  note         = {{Accessed: {today}}},\n"
-                    f"}}\n"
-                )
-                repl = clean_protected_case(misc)
-
-            # ─── 2) ArXiv URL → resolve to DOI → fetch BibTeX ────────────────
-            if repl is None and not doi and 'arxiv.org/abs' in urlf:
-                aid = urlf.rstrip('/').split('/')[-1]
-                try:
-                    arxiv_doi = extract_arxiv_doi(aid)
-                    if arxiv_doi not in used_dois:
-                        repl = fetch_bibtex_from_doi(arxiv_doi)
-                        used_dois.add(arxiv_doi)
-                except Exception:
-                    pass
-
-            # ─── 3) No DOI → metadata search with exact title match ───────────
-            if repl is None and not doi:
-                try:
-                    found = search_doi_by_metadata(ent.get('title',''),
-                                                   ent.get('author',''))
-                    if found not in used_dois:
-                        repl = fetch_bibtex_from_doi(found)
-                        used_dois.add(found)
-                    else:
-                        print(f" SKIPPING duplicate DOI {found} for {key}")
-                except Exception as e:
-                    print(f" • metadata search failed for {key}: {e}")
-
-            # ─── 4) Direct DOI present → fetch BibTeX ─────────────────────────
-            if repl is None and doi:
-                if doi not in used_dois:
-                    repl = fetch_bibtex_from_doi(doi)
-                    used_dois.add(doi)
-
-            # ─── 5) Fallback to original formatting ───────────────────────────
-            if repl is None:
-                db = BibDatabase()
-                db.entries = [ent]
-                repl = clean_protected_case(writer.write(db))
+    db = bibtexparser.loads(raw_text, parser)
+    parsed = collections.defaultdict(collections.deque)
+    for ent in db.entries:
+        parsed[ent['ID']].append(ent)
 
-        else:
-            # ─── Raw block: try to extract DOI or URL and fetch, else clean ───
-            block = m.group(0)
-            m1 = re.search(r'DOI\s*=\s*\{([^}]+)\}', block, re.IGNORECASE)
-            doi = m1.group(1) if m1 else None
-            if not doi:
-                m2 = re.search(r'url\s*=\s*\{([^}]+)\}', block, re.IGNORECASE)
-                if m2 and 'doi.org' in m2.group(1):
-                    doi = m2.group(1).split('doi.org/')[-1]
-            if doi and doi not in used_dois:
-                try:
-                    repl = fetch_bibtex_from_doi(doi)
-                    used_dois.add(doi)
-                except Exception:
-                    pass
-            if repl is None:
-                repl = clean_protected_case(block)
-
-        replacements.append({'start': start, 'end': end, 'text': repl})
-
-    # Apply replacements from bottom to top
-    new_text = raw_text
-    for r in sorted(replacements, key=lambda x: x['start'], reverse=True):
-        new_text = new_text[:r['start']] + r['text'] + new_text[r['end']:]
-
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(new_text)
+    # Stage 1: map every raw block to its parsed entry and classify it (cheap,
+    # no network). Blocks the parser dropped are kept as raw text, and looked
+    # up only if a DOI can be read out of them. This finishes before any
+    # lookup starts, since DOI ownership and batching need the full set
+    pieces, tasks = [], []
+    for etype, key, start, end in split_bib_blocks(raw_text):
+        ent = parsed[key].popleft() if etype and parsed.get(key) else None
+        if ent is not None:
+            tasks.append((len(pieces), ent, classify_entry(ent)))
+        elif etype:
+            doi = raw_block_doi(raw_text[start:end])
+            if doi:
+                tasks.append((len(pieces), {'ID': key, 'doi': doi}, 'doi'))
+        pieces.append((etype, ent, start, end))
+
+    # Index entries by DOI; the first entry (in file order) carrying a DOI
+    # owns it. Listed DOIs are claimed up front, so a discovered DOI never
+    # takes one; discovered DOIs are claimed in stage 3, lowest index first
+    doi_index = {}
+    for _, ent, branch in tasks:
+        if branch == 'doi':
+            doi_index.setdefault(entry_doi(ent), ent)
+    used_dois.claim_all(doi_index)
+
+    # Stage 2: lookups run on MAX_WORKERS threads, fed through fetch_q
+    fetch_q, done_q = queue.Queue(), queue.Queue()
+    prefetched      = {}  # filled below, before any 'doi' task is queued
+    for _ in range(MAX_WORKERS):
+        threading.Thread(target=fetch_worker, daemon=True,
+                         args=(fetch_q, done_q, doi_index, prefetched)).start()
+
+    # From here on any error stops the workers; the output is only
+    # replaced once every piece is written, so it is left as it was
+    try:
+        # URL‑only entries and metadata searches (the slowest branch, two
+        # serial requests each) don't depend on any prefetch, so they start
+        # right away
+        deferred = []
+        for task in tasks:
+            if task[2] in ('url', 'metadata'):
+                fetch_q.put(task)
+            else:
+                deferred.append(task)
+
+        # Meanwhile resolve all listed DOIs in a few batched CrossRef queries
+        # and warm the cache with every arXiv DOI in ceil(N/100) arXiv API
+        # queries; the two hit different hosts, so they run side by side
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            works = pool.submit(fetch_crossref_works, doi_index)
+            pool.submit(fetch_arxiv_dois, [
+                arxiv_id(ent['url']) for _, ent, branch in deferred if branch == 'arxiv'
+            ]).result()
+            prefetched.update(works.result())
+
+        # Then the DOI and arXiv entries, which now mostly hit warm data
+        for task in deferred:
+            fetch_q.put(task)
+        for _ in range(MAX_WORKERS):
+            fetch_q.put(None)
+
+        # Stage 3 (this thread): write the file back block by block, in file
+        # order, while the remaining lookups are still in flight. Text between
+        # entries is copied as is; fetched BibTeX replaces its block, untouched
+        # entries go through the writer and unreadable blocks are only cleaned
+        looked_up = {i for i, _, _ in tasks}
+        done      = {}
+        with atomic_output(output_path) as fo:
+            for i, (etype, ent, start, end) in enumerate(pieces):
+                text = raw_text[start:end]
+                if i not in looked_up:
+                    fo.write(clean_protected_case(text) if etype else text)
+                    continue
+                while i not in done:
+                    j, result = done_q.get()
+                    done[j] = result
+                result = done.pop(i)
+                if isinstance(result, Exception):
+                    raise result
+                doi, repl = result
+                if doi and not used_dois.claim(doi):
+                    print(f" SKIPPING duplicate DOI {doi} for {ent['ID']}")
+                    repl = None
+                if repl is None:
+                    repl = text if ent is None else WRITER._entry_to_bibtex(ent)
+                # keep the newlines a truncated block carried up to the next entry
+                body = text.rstrip('\n')
+                fo.write(clean_protected_case(repl).rstrip('\n') + text[len(body):])
+    except BaseException:
+        stop_workers(fetch_q)
+        raise
     print(f"Finished writing enriched .bib → {output_path}")
 
 # ─── CLI entry point ──────────────────────────────────────────────────────────